@@ -16,9 +16,14 @@ from typing import Callable, Union, Optional, Mapping, TYPE_CHECKING, List, \
 import wandb
 import numpy as np
 import torch
+
+try:
+    import triton
+    import triton.language as tl
+except ImportError:
+    triton = None
 from PIL.Image import Image
 from torch import Tensor
-from torch.nn.functional import pad
 
 from avalanche.benchmarks import NCScenario
 from avalanche.evaluation import PluginMetric, Metric
@@ -31,6 +36,75 @@ if TYPE_CHECKING:
     from avalanche.training import BaseStrategy
 
 
+_INT32_SAFE_SAMPLES = 2 ** 30
+"""
+Number of accumulated samples after which int32 cell counters could
+overflow: past this point the matrix is promoted to int64.
+"""
+
+_PENDING_FLUSH_THRESHOLD = 2 ** 14
+"""
+Number of buffered samples after which `StreamConfusionMatrix` flushes
+its pending minibatches into the running matrix.
+"""
+
+_NUMPY_SMALL_BATCH = 4096
+"""
+Below this number of samples, CPU updates go through numpy's bincount,
+which has lower call overhead than the torch kernels.
+"""
+
+_NUMPY_SMALL_MATRIX = 2 ** 16
+"""
+Largest backing-buffer size (in elements) for which the numpy path is
+used: bincount materializes a matrix-sized temporary, which is only
+cheap while the matrix itself is small.
+"""
+
+_FUSED_MAX_CLASSES = 2 ** 14
+"""
+Widest logits row handled by the fused Triton update: the kernel loads a
+whole row per program, so wider rows would exceed the per-block limits
+and must take the standard argmax + scatter-add path.
+"""
+
+
+if triton is not None:
+    @triton.jit
+    def _fused_cm_update_kernel(logits_ptr, true_ptr, cm_ptr, n_cols,
+                                logits_row_stride, cm_row_stride,
+                                BLOCK_SIZE: tl.constexpr):
+        """
+        Fused logits-to-confusion-matrix update: each program computes the
+        argmax of one logits row and atomically increments the matching
+        matrix cell, so no intermediate label/index tensors are ever
+        materialized.
+        """
+        row_idx = tl.program_id(0)
+        col_offsets = tl.arange(0, BLOCK_SIZE)
+        mask = col_offsets < n_cols
+        row = tl.load(logits_ptr + row_idx * logits_row_stride + col_offsets,
+                      mask=mask, other=float('-inf'))
+        predicted = tl.argmax(row, axis=0)
+        true_label = tl.load(true_ptr + row_idx)
+        tl.atomic_add(cm_ptr + true_label * cm_row_stride + predicted, 1)
+
+
+@torch.jit.script
+def _accumulate_cm_cpu(cm: Tensor, true_y: Tensor,
+                       predicted_y: Tensor) -> None:
+    """
+    Compiled scatter-add equivalent to "cm[true_y, predicted_y] += 1".
+
+    Running the whole accumulation as a single TorchScript call removes the
+    per-operator Python dispatch overhead, which dominates on CPU for small
+    minibatches.
+    """
+    flat_idx = true_y * cm.size(1) + predicted_y
+    cm.view(-1).index_add_(
+        0, flat_idx, torch.ones_like(flat_idx, dtype=cm.dtype))
+
+
 class ConfusionMatrix(Metric[Tensor]):
     """
     The standalone confusion matrix metric.
@@ -60,7 +134,8 @@ class ConfusionMatrix(Metric[Tensor]):
     """
 
     def __init__(self, num_classes: int = None,
-                 normalize: Literal['true', 'pred', 'all'] = None):
+                 normalize: Literal['true', 'pred', 'all'] = None,
+                 check_inputs: bool = True):
         """
         Creates an instance of the standalone confusion matrix metric.
 
@@ -78,15 +153,41 @@ class ConfusionMatrix(Metric[Tensor]):
             there can be no label greater than `num_classes`.
         :param normalize: how to normalize confusion matrix.
             None to not normalize
+        :param check_inputs: If True, label values will be checked against
+            the valid `[0, num_classes)` range. Setting this to False skips
+            the checks (and the related device synchronizations), which is
+            useful in trusted evaluation loops. Only considered when
+            `num_classes` is not None. Defaults to True.
         """
         self._cm_tensor: Optional[Tensor] = None
         """
-        The Tensor where the running confusion matrix is stored.
+        The Tensor where the running confusion matrix is stored. This is a
+        view over the first `n_classes` columns of `_cm_buffer`.
+        """
+
+        self._cm_buffer: Optional[Tensor] = None
+        """
+        The backing storage of `_cm_tensor`, with rows padded to a multiple
+        of 8 elements so that row-wise kernels can run at full SIMD width.
         """
         self._num_classes: Optional[int] = num_classes
 
+        self._num_samples: int = 0
+        """
+        The number of accumulated samples, used to detect when the int32
+        counters must be promoted to int64.
+        """
+
         self.normalize = normalize
 
+        self._check_inputs = check_inputs
+
+        if num_classes is not None:
+            # The matrix size is known in advance: allocate it once so that
+            # updates never need to check or enlarge it.
+            self._cm_buffer, self._cm_tensor = \
+                ConfusionMatrix._new_cm_buffer(num_classes, torch.int32)
+
     @torch.no_grad()
     def update(self, true_y: Tensor, predicted_y: Tensor) -> None:
         """
@@ -108,49 +209,104 @@ class ConfusionMatrix(Metric[Tensor]):
             raise ValueError('Confusion matrix supports predictions with at '
                              'most 2 dimensions')
 
-        max_label = -1 if self._num_classes is None else self._num_classes - 1
+        if self._num_classes is not None:
+            self._update_fixed_size(true_y, predicted_y)
+        else:
+            self._update_infer_size(true_y, predicted_y)
 
-        # SELECT VALID PORTION OF TARGET AND PREDICTIONS
-        true_y = torch.as_tensor(true_y)
-        if len(true_y.shape) == 2 and self._num_classes is not None:
-            true_y = true_y[:, :max_label+1]
-        predicted_y = torch.as_tensor(predicted_y)
-        if len(predicted_y.shape) == 2 and self._num_classes is not None:
-            predicted_y = predicted_y[:, :max_label+1]
+    def _update_fixed_size(self, true_y: Tensor, predicted_y: Tensor) -> None:
+        """
+        Fast update path used when `num_classes` is known: the matrix is
+        already allocated, so no max-label bookkeeping is needed and the
+        critical section reduces to a single scatter-add.
+        """
+        n_classes = self._num_classes
+
+        if len(true_y.shape) == 2:
+            # Logits -> transform to labels
+            true_y = torch.argmax(true_y[:, :n_classes], dim=1)
+        elif self._check_inputs:
+            # Labels -> one fused range check, costing a single host sync;
+            # the error cause is only disentangled on the failure path
+            if ((true_y < 0) | (true_y >= n_classes)).any().item():
+                if (true_y < 0).any().item():
+                    raise ValueError(
+                        'Label values must be non-negative values')
+                raise ValueError("Encountered target label larger than"
+                                 "num_classes")
+
+        if len(predicted_y.shape) == 2:
+            logits = predicted_y[:, :n_classes]
+            # The fused kernel loads one row per program along a unit
+            # column stride and masks with -inf: anything else (strided
+            # views, integer one-hot predictions, very wide rows) must
+            # fall back to the standard path.
+            if triton is not None and logits.is_cuda and true_y.is_cuda \
+                    and logits.stride(1) == 1 \
+                    and logits.is_floating_point() \
+                    and logits.shape[1] <= _FUSED_MAX_CLASSES \
+                    and self._cm_buffer.dtype == torch.int32 \
+                    and self._num_samples < _INT32_SAFE_SAMPLES:
+                self._update_fused_gpu(true_y, logits)
+                return
+            # Logits -> transform to labels
+            predicted_y = torch.argmax(logits, dim=1)
+        elif self._check_inputs:
+            # Labels -> one fused range check, costing a single host sync;
+            # the error cause is only disentangled on the failure path
+            if ((predicted_y < 0) | (predicted_y >= n_classes)).any().item():
+                if (predicted_y < 0).any().item():
+                    raise ValueError(
+                        'Label values must be non-negative values')
+                raise ValueError("Encountered predicted label larger than"
+                                 "num_classes")
+
+        self._accumulate(true_y, predicted_y)
+
+    def _update_fused_gpu(self, true_y: Tensor, logits: Tensor) -> None:
+        """
+        GPU update that consumes the logits directly: a single Triton
+        kernel fuses the row argmax with the scatter-add, so none of the
+        intermediate label/index tensors of the standard path are ever
+        materialized.
+        """
+        self._num_samples += len(true_y)
+        if self._cm_buffer.device != logits.device:
+            self._rebind_buffer(self._cm_buffer.to(logits.device))
+        block_size = triton.next_power_of_2(logits.shape[1])
+        _fused_cm_update_kernel[(logits.shape[0],)](
+            logits, true_y.to(torch.int64).contiguous(), self._cm_buffer,
+            logits.shape[1], logits.stride(0), self._cm_buffer.stride(0),
+            BLOCK_SIZE=block_size)
+
+    def _update_infer_size(self, true_y: Tensor, predicted_y: Tensor) -> None:
+        """
+        General update path used when `num_classes` is unknown: the maximum
+        label has to be tracked and the matrix enlarged when needed.
+        """
+        max_label = -1
 
-        # COMPUTE MAX LABEL AND CONVERT TARGET AND PREDICTIONS IF NEEDED
         if len(predicted_y.shape) > 1:
             # Logits -> transform to labels
-            if self._num_classes is None:
-                max_label = max(max_label, predicted_y.shape[1]-1)
-            predicted_y = torch.max(predicted_y, 1)[1]
+            max_label = max(max_label, predicted_y.shape[1]-1)
+            predicted_y = torch.argmax(predicted_y, dim=1)
         else:
-            # Labels -> check non-negative
-            min_label = torch.min(predicted_y).item()
-            if min_label < 0:
+            # Labels -> check non-negative and track the maximum
+            p_min, p_max = torch.aminmax(predicted_y)
+            if p_min.item() < 0:
                 raise ValueError('Label values must be non-negative values')
-            if self._num_classes is None:
-                max_label = max(max_label, torch.max(predicted_y).item())
-            elif torch.max(predicted_y).item() >= self._num_classes:
-                raise ValueError("Encountered predicted label larger than"
-                                 "num_classes")
+            max_label = max(max_label, p_max.item())
 
         if len(true_y.shape) > 1:
             # Logits -> transform to labels
-            if self._num_classes is None:
-                max_label = max(max_label, true_y.shape[1]-1)
-            true_y = torch.max(true_y, 1)[1]
+            max_label = max(max_label, true_y.shape[1]-1)
+            true_y = torch.argmax(true_y, dim=1)
         else:
-            # Labels -> check non-negative
-            min_label = torch.min(true_y).item()
-            if min_label < 0:
+            # Labels -> check non-negative and track the maximum
+            t_min, t_max = torch.aminmax(true_y)
+            if t_min.item() < 0:
                 raise ValueError('Label values must be non-negative values')
-
-            if self._num_classes is None:
-                max_label = max(max_label, torch.max(true_y).item())
-            elif torch.max(true_y).item() >= self._num_classes:
-                raise ValueError("Encountered target label larger than"
-                                 "num_classes")
+            max_label = max(max_label, t_max.item())
 
         if max_label < 0:
             raise ValueError('The Confusion Matrix metric can only handle '
@@ -158,16 +314,100 @@ class ConfusionMatrix(Metric[Tensor]):
 
         if self._cm_tensor is None:
             # Create the confusion matrix
-            self._cm_tensor = torch.zeros((max_label+1, max_label+1),
-                                          dtype=torch.long)
+            self._cm_buffer, self._cm_tensor = \
+                ConfusionMatrix._new_cm_buffer(max_label+1, torch.int32,
+                                               predicted_y.device)
         elif max_label >= self._cm_tensor.shape[0]:
             # Enlarge the confusion matrix
-            size_diff = 1 + max_label - self._cm_tensor.shape[0]
-            self._cm_tensor = pad(self._cm_tensor,
-                                  (0, size_diff, 0, size_diff))
+            new_size = max_label + 1
+            if new_size <= self._cm_buffer.shape[0]:
+                # The backing storage is already large enough: just widen
+                # the logical view (the spare area is still zeroed).
+                self._cm_tensor = self._cm_buffer[:new_size, :new_size]
+            else:
+                # Grow the capacity geometrically so that the total copy
+                # work stays amortized O(C^2) over the whole stream.
+                new_capacity = max(new_size, 2 * self._cm_buffer.shape[0])
+                old_cm = self._cm_tensor
+                self._cm_buffer, self._cm_tensor = \
+                    ConfusionMatrix._new_cm_buffer(new_size, old_cm.dtype,
+                                                   old_cm.device,
+                                                   capacity=new_capacity)
+                self._cm_tensor[:old_cm.shape[0], :old_cm.shape[1]] \
+                    .copy_(old_cm)
+
+        self._accumulate(true_y, predicted_y)
 
-        for pattern_idx in range(len(true_y)):
-            self._cm_tensor[true_y[pattern_idx]][predicted_y[pattern_idx]] += 1
+    @staticmethod
+    def _new_cm_buffer(n_classes, dtype, device=None, capacity=None):
+        """
+        Allocates a zeroed `n_classes` x `n_classes` matrix backed by
+        storage whose rows are padded to a multiple of 8 elements, so that
+        row-wise reductions run at full SIMD width with no scalar tail.
+
+        :param capacity: the number of classes the backing storage can hold
+            before a reallocation is needed. Defaults to None, which means
+            `n_classes`.
+        :return: the padded backing buffer and the logical
+            `n_classes, n_classes` view over it.
+        """
+        if capacity is None:
+            capacity = n_classes
+        padded_cols = (capacity + 7) & ~7
+        buffer = torch.zeros((capacity, padded_cols), dtype=dtype,
+                             device=device)
+        return buffer, buffer[:n_classes, :n_classes]
+
+    def _rebind_buffer(self, new_buffer: Tensor) -> None:
+        n_classes = self._cm_tensor.shape[1]
+        self._cm_buffer = new_buffer
+        self._cm_tensor = new_buffer[:n_classes, :n_classes]
+
+    def _accumulate(self, true_y: Tensor, predicted_y: Tensor) -> None:
+        # Counts are kept as int32 to halve the bytes moved by the
+        # scatter-add; promote to int64 before overflow becomes possible.
+        self._num_samples += true_y.numel()
+        if self._num_samples > _INT32_SAFE_SAMPLES and \
+                self._cm_buffer.dtype == torch.int32:
+            self._rebind_buffer(self._cm_buffer.to(torch.int64))
+
+        if self._cm_buffer.device != predicted_y.device:
+            # Accumulate on the same device as the incoming predictions:
+            # this avoids a device round-trip per minibatch, at the cost of
+            # a single transfer when the result is retrieved.
+            self._rebind_buffer(self._cm_buffer.to(predicted_y.device))
+
+        # Accumulate all (true, predicted) pairs with a single vectorized
+        # scatter-add: this is "cm[true_y, predicted_y] += 1", without
+        # materializing any intermediate matrix-sized buffer.
+        true_idx = true_y.view(-1).to(torch.int64)
+        pred_idx = predicted_y.view(-1).to(torch.int64)
+        if self._cm_buffer.device.type == 'cpu':
+            if true_idx.numel() < _NUMPY_SMALL_BATCH \
+                    and self._cm_buffer.numel() <= _NUMPY_SMALL_MATRIX:
+                # For tiny batches even a single compiled torch call is
+                # dominated by dispatch overhead: count pairs with numpy's
+                # bincount and add them into the shared-memory view. The
+                # bincount output spans the whole matrix, so this is only
+                # worthwhile while the matrix itself is small.
+                stride = self._cm_buffer.shape[1]
+                flat_idx = true_idx.numpy() * stride + pred_idx.numpy()
+                cm_np = self._cm_buffer.view(-1).numpy()
+                cm_np += np.bincount(flat_idx, minlength=cm_np.size)
+            else:
+                # The compiled kernel indexes the flattened backing buffer,
+                # so it receives the padded storage (and its row stride)
+                # directly.
+                _accumulate_cm_cpu(self._cm_buffer, true_idx, pred_idx)
+        else:
+            # scatter_add_ into the flattened backing buffer: a single
+            # fused kernel that, unlike index_put_, does not go through
+            # the advanced-indexing machinery and, unlike bincount, never
+            # initializes a minlength-sized intermediate.
+            flat_idx = true_idx * self._cm_buffer.shape[1] + pred_idx
+            self._cm_buffer.view(-1).scatter_add_(
+                0, flat_idx,
+                torch.ones_like(flat_idx, dtype=self._cm_buffer.dtype))
 
     def result(self) -> Tensor:
         """
@@ -182,10 +422,12 @@ class ConfusionMatrix(Metric[Tensor]):
             if self._num_classes is not None:
                 matrix_shape = (self._num_classes, self._num_classes)
             return torch.zeros(matrix_shape, dtype=torch.long)
+        # The matrix is accumulated on the device of the input tensors:
+        # move it to the CPU only when the result is requested.
+        matrix = self._cm_tensor.cpu()
         if self.normalize is not None:
-            return ConfusionMatrix._normalize_cm(self._cm_tensor,
-                                                 self.normalize)
-        return self._cm_tensor
+            return ConfusionMatrix._normalize_cm(matrix, self.normalize)
+        return matrix.to(torch.int64)
 
     def reset(self) -> None:
         """
@@ -196,7 +438,13 @@ class ConfusionMatrix(Metric[Tensor]):
 
         :return: None.
         """
-        self._cm_tensor = None
+        if self._num_classes is not None:
+            self._cm_buffer, self._cm_tensor = \
+                ConfusionMatrix._new_cm_buffer(self._num_classes, torch.int32)
+        else:
+            self._cm_buffer = None
+            self._cm_tensor = None
+        self._num_samples = 0
 
     @staticmethod
     def _normalize_cm(cm: Tensor,
@@ -206,23 +454,18 @@ class ConfusionMatrix(Metric[Tensor]):
                              ' \'pred\' or \'all\'')
 
         if normalization == 'true':
-            cm = cm / cm.sum(dim=1, keepdim=True, dtype=torch.float64)
+            denom = cm.sum(dim=1, keepdim=True, dtype=torch.float64)
         elif normalization == 'pred':
-            cm = cm / cm.sum(dim=0, keepdim=True, dtype=torch.float64)
-        elif normalization == 'all':
-            cm = cm / cm.sum(dtype=torch.float64)
-        cm = ConfusionMatrix.nan_to_num(cm)
-        return cm
+            denom = cm.sum(dim=0, keepdim=True, dtype=torch.float64)
+        else:
+            denom = cm.sum(dtype=torch.float64)
+        # Empty rows/columns would give 0/0: clamping the denominator to 1
+        # produces the same all-zero entries without a NaN-fixup pass.
+        return cm.to(torch.float64).div_(denom.clamp_min_(1.0))
 
     @staticmethod
     def nan_to_num(matrix: Tensor) -> Tensor:
-        # if version.parse(torch.__version__) >= version.parse("1.8.0"):
-        #    # noinspection PyUnresolvedReferences
-        #    return torch.nan_to_num(matrix)
-
-        numpy_ndarray = matrix.numpy()
-        numpy_ndarray = np.nan_to_num(numpy_ndarray)
-        return torch.tensor(numpy_ndarray, dtype=matrix.dtype)
+        return torch.nan_to_num(matrix)
 
 
 class StreamConfusionMatrix(PluginMetric[Tensor]):
@@ -289,15 +532,60 @@ class StreamConfusionMatrix(PluginMetric[Tensor]):
                                                         normalize=normalize)
         self._image_creator = image_creator
 
+        self._pending_true: List[Tensor] = []
+        self._pending_pred: List[Tensor] = []
+        self._pending_samples: int = 0
+
+        self._cm_version: int = 0
+        self._cached_image: Optional[Image] = None
+        self._cached_version: int = -1
+
     def reset(self) -> None:
         self._matrix = ConfusionMatrix(num_classes=self.num_classes,
                                        normalize=self.normalize)
+        self._pending_true = []
+        self._pending_pred = []
+        self._pending_samples = 0
+        self._cm_version += 1
 
     def result(self) -> Tensor:
+        self._flush_pending()
         exp_cm = self._matrix.result()
         return exp_cm
 
     def update(self, true_y: Tensor, predicted_y: Tensor) -> None:
+        # Minibatches are buffered and accumulated into the matrix in a
+        # single update once enough samples piled up: this amortizes the
+        # per-update kernel launches across many more samples.
+        if self._pending_true and not (
+                StreamConfusionMatrix._cat_compatible(
+                    self._pending_true[-1], true_y)
+                and StreamConfusionMatrix._cat_compatible(
+                    self._pending_pred[-1], predicted_y)):
+            # The incoming tensors cannot be concatenated with the buffered
+            # ones (e.g. logits of a different width, or labels mixed with
+            # logits): accumulate what is pending and start a new buffer.
+            self._flush_pending()
+        self._pending_true.append(true_y.detach())
+        self._pending_pred.append(predicted_y.detach())
+        self._pending_samples += len(true_y)
+        self._cm_version += 1
+        if self._pending_samples >= _PENDING_FLUSH_THRESHOLD:
+            self._flush_pending()
+
+    @staticmethod
+    def _cat_compatible(buffered: Tensor, incoming: Tensor) -> bool:
+        return len(buffered.shape) == len(incoming.shape) and \
+            buffered.shape[1:] == incoming.shape[1:]
+
+    def _flush_pending(self) -> None:
+        if not self._pending_true:
+            return
+        true_y = torch.cat(self._pending_true, dim=0)
+        predicted_y = torch.cat(self._pending_pred, dim=0)
+        self._pending_true = []
+        self._pending_pred = []
+        self._pending_samples = 0
         self._matrix.update(true_y, predicted_y)
 
     def before_eval(self, strategy) -> None:
@@ -322,14 +610,20 @@ class StreamConfusionMatrix(PluginMetric[Tensor]):
         plot_x_position = strategy.clock.train_iterations
 
         if self._save_image:
-            class_order = self._get_display_class_order(exp_cm, strategy)
-
-            cm_image = self._image_creator(
-                exp_cm[class_order][:, class_order],
-                class_order
-            )
+            if self._cached_version != self._cm_version:
+                # Rendering the matrix through matplotlib is expensive:
+                # only re-create the image when the matrix changed since
+                # the last call (e.g. it is queried by multiple loggers).
+                class_order = self._get_display_class_order(exp_cm, strategy)
+
+                self._cached_image = self._image_creator(
+                    exp_cm[class_order][:, class_order],
+                    class_order
+                )
+                self._cached_version = self._cm_version
             metric_representation = MetricValue(
-                self, metric_name, AlternativeValues(cm_image, exp_cm),
+                self, metric_name,
+                AlternativeValues(self._cached_image, exp_cm),
                 plot_x_position)
         else:
             metric_representation = MetricValue(
@@ -98,6 +98,11 @@ class GeneralMetricTests(unittest.TestCase):
         metric.update(self.y, self.out)
         cm = metric.result()
         self.assertTrue((cm >= 0).all().item())
+        pred = torch.max(self.out, 1)[1]
+        ref_cm = torch.zeros(cm.shape, dtype=torch.long)
+        for i in range(len(self.y)):
+            ref_cm[self.y[i]][pred[i]] += 1
+        self.assertTrue(torch.equal(cm, ref_cm))
         metric.reset()
         cm = metric.result()
         self.assertTrue((cm == 0).all().item())